@@ -18,10 +18,17 @@ import aiofiles
 import asyncio
 import logging
 import argparse
-import time
+import random
 
+from concurrent.futures import Executor, ProcessPoolExecutor
 from shutil import copyfileobj
 
+TAB_SEPARATOR: re.Pattern = re.compile(r'\t+')
+HASH_BLOCK_SIZE: int = 1 << 20
+DOWNLOAD_BLOCK_SIZE: int = 64 * 1024
+RANGE_THRESHOLD: int = 16 << 20
+RANGE_PARTS: int = 4
+
 
 def get_args() -> argparse.Namespace:
     """
@@ -48,36 +55,85 @@ async def get_file_info(path: str) -> tuple[str, int, list]:
     :param path: str - the path to the file
     :return: str, int, list - the build id, number of entries, and entries
     """
-    async with aiofiles.open(path, 'r') as f:
-        lines: list[str] = await f.readlines()
-    build_id: str = lines[0].split('=')[1].strip()
-    num_entries: int = int(lines[1].split('=')[1].strip())
-    entries: list = []
-    for line in lines[2:]:
-        entries.append(re.split(r'\t+', line.strip()))
+    # the manifest is small, so a plain read is cheaper than a trip through aiofiles' thread pool
+    with open(path, 'r') as f:
+        lines: list[str] = f.read().splitlines()
+    build_id: str = lines[0].partition('=')[2].strip()
+    num_entries: int = int(lines[1].partition('=')[2])
+    entries: list = [TAB_SEPARATOR.split(line.strip()) for line in lines[2:]]
     return build_id, num_entries, entries
 
 
-async def download(session: aiohttp.client.ClientSession, url, path) -> None:
+async def download_range(session: aiohttp.client.ClientSession, url: str, path: str, start: int, end: int) -> bool:
+    """
+    Downloads part of a file into an existing file on disk.
+    :param session: The aiohttp session
+    :param url: The url to download from
+    :param path: The path to save the file to
+    :param start: The first byte to download
+    :param end: The last byte to download (inclusive)
+    :return: bool - False if the server ignored the range and sent the whole file instead
+    """
+    async with session.get(url, headers={'Range': f'bytes={start}-{end}'}) as response:
+        response.raise_for_status()
+        if response.status != 206:
+            return False
+        async with aiofiles.open(path, 'r+b') as f:
+            await f.seek(start)
+            async for chunk in response.content.iter_chunked(DOWNLOAD_BLOCK_SIZE):
+                await f.write(chunk)
+    return True
+
+
+async def download(session: aiohttp.client.ClientSession, url, path, size: int) -> None:
     """
     Downloads a file and saves to disk.
+    Large files are split into parallel range requests when the server supports them.
     :param session: The aiohttp session
     :param url: The url to download from
     :param path: The path to save the file to
+    :param size: The file size listed in the build manifest
     :return: None
     """
+    length: int | None = None
+    ranged: bool = False
+    # only large files are worth the extra round trip to check for range support
+    if size >= RANGE_THRESHOLD:
+        async with session.head(url) as response:
+            length = response.content_length if response.status == 200 else None
+            ranged = response.headers.get('Accept-Ranges', '').lower() == 'bytes'
+    if ranged and length is not None and length >= RANGE_THRESHOLD:
+        with open(path, 'wb') as f:
+            f.truncate(length)
+        part_size: int = -(-length // RANGE_PARTS)
+        tasks: list[asyncio.Task] = [
+            asyncio.ensure_future(download_range(session, url, path, start, min(start + part_size, length) - 1))
+            for start in range(0, length, part_size)]
+        try:
+            ranges: list[bool] = await asyncio.gather(*tasks)
+        except BaseException:
+            # stop the other parts before a retry reopens the file, or they keep writing into it
+            for task in tasks:
+                task.cancel()
+            await asyncio.gather(*tasks, return_exceptions=True)
+            raise
+        if all(ranges):
+            return
+        logging.info('Server ignored range requests for %s, downloading it in one piece', url)
     async with session.get(url) as response:
         response.raise_for_status()
         async with aiofiles.open(path, 'wb') as f:
-            await f.write(await response.read())
+            async for chunk in response.content.iter_chunked(DOWNLOAD_BLOCK_SIZE):
+                await f.write(chunk)
 
 
-async def download_file(url: str, path: str, retries: int, wait: int | float, verbose: bool, build_id: str, base: str,
-                        session: aiohttp.client.ClientSession) -> None:
+async def download_file(url: str, path: str, size: int, retries: int, wait: int | float, verbose: bool, build_id: str,
+                        base: str, session: aiohttp.client.ClientSession) -> None:
     """
     Constructs the url and downloads the file to disk.
     :param url: The path to download from
     :param path: The path to download from
+    :param size: The file size listed in the build manifest
     :param retries: How many times to retry the download
     :param wait: How long to wait between retries
     :param verbose: Whether to log verbose messages
@@ -92,29 +148,64 @@ async def download_file(url: str, path: str, retries: int, wait: int | float, ve
     logging.info('Downloading %s to %s', url, path)
     for i in range(retries):
         try:
-            await download(session, url, path)
+            await download(session, url, path, size)
             logging.info('Downloaded %s successfully :D', path)
             break
         except Exception as e:
             if i == retries - 1:
+                # a failed ranged download leaves a full length file behind that the skip check would accept
+                if os.path.exists(path):
+                    os.remove(path)
                 raise e
+            # back off exponentially, with jitter so retries don't all hit the CDN at once
+            delay: float = wait * 2 ** i + random.uniform(0, 0.5)
             if verbose:
-                logging.warning('Failed to download %s (%s), retrying in %d seconds', url, e, wait)
-            time.sleep(wait)
+                logging.warning('Failed to download %s (%s), retrying in %.1f seconds', url, e, delay)
+            await asyncio.sleep(delay)
 
 
-async def check_file(path: str, sha1: str) -> bool:
+async def download_worker(queue: asyncio.Queue, retries: int, wait: int | float, verbose: bool, build_id: str,
+                          base: str, session: aiohttp.client.ClientSession) -> None:
+    """
+    Downloads queued entries one at a time until the queue is empty.
+    :param queue: The queue of (url, path, size) entries to download
+    :param retries: How many times to retry each download
+    :param wait: How long to wait between retries
+    :param verbose: Whether to log verbose messages
+    :param build_id: The build id for the url
+    :param base: The base url to download from
+    :param session: The aiohttp session
+    :return: None
+    """
+    while not queue.empty():
+        url, path, size = queue.get_nowait()
+        await download_file(url, path, size, retries, wait, verbose, build_id, base, session)
+
+
+def _sha1_file(path: str) -> str:
+    """
+    Hashes a file in fixed-size blocks so memory use doesn't scale with file size.
+    :param path: The path to the file
+    :return: str - the hex sha1 digest of the file
+    """
+    h = hashlib.new('sha1')
+    with open(path, 'rb') as f:
+        while chunk := f.read(HASH_BLOCK_SIZE):
+            h.update(chunk)
+    return h.hexdigest()
+
+
+async def check_file(path: str, sha1: str, executor: Executor | None = None) -> bool:
     """
     Checks if a file exists and has the correct sha1 hash.
     :param path: The path to the file
     :param sha1: The sha1 hash to check against
+    :param executor: The executor to hash in, or None for the loop's default
     :return: bool - whether the file exists and has the correct sha1 hash
     """
     if not os.path.exists(path):
         return False
-    with open(path, 'rb') as f:
-        data: bytes = f.read()
-    return hashlib.sha1(data).hexdigest() == sha1
+    return await asyncio.get_running_loop().run_in_executor(executor, _sha1_file, path) == sha1
 
 
 async def main() -> None:
@@ -125,27 +216,36 @@ async def main() -> None:
     args: argparse.Namespace = get_args()
     logging.basicConfig(level=logging.DEBUG if args.verbose else logging.INFO)
     build_id, num_entries, entries = await get_file_info(args.file)
-    if args.dir:
-        os.chdir(args.dir)
-    else:
-        os.chdir("D:/Battle Breakers/")
-    if not os.path.exists(build_id):
-        os.mkdir(build_id)
-    os.chdir(build_id)
-    if not os.path.exists(entries[0][4].split('/')[0]):
-        os.mkdir(entries[0][4].split('/')[0])
-    session: aiohttp.client.ClientSession = aiohttp.ClientSession()
-    tasks: list = []
+    build_dir: str = os.path.join(args.dir or "D:/Battle Breakers/", build_id)
+    os.makedirs(os.path.join(build_dir, entries[0][4].split('/')[0]), exist_ok=True)
+    if args.skip:
+        # list each directory once rather than checking every entry on disk
+        existing: set[str] = set()
+        for directory in {os.path.dirname(entry[4]) for entry in entries}:
+            try:
+                with os.scandir(os.path.join(build_dir, directory)) as it:
+                    # match the manifest's forward slash paths exactly
+                    existing.update(f"{directory}/{e.name}" if directory else e.name for e in it)
+            except FileNotFoundError:
+                continue
+        entries = [entry for entry in entries if entry[4] not in existing]
+    if args.check:
+        # hash existing files on every core at once rather than one after another
+        with ProcessPoolExecutor(max_workers=os.cpu_count()) as pool:
+            valid: list[bool] = await asyncio.gather(
+                *[check_file(os.path.join(build_dir, entry[4]), entry[2].split(':')[1], pool) for entry in entries])
+        entries = [entry for entry, ok in zip(entries, valid) if not ok]
+    # each worker can fan a large file out into RANGE_PARTS requests, so leave room for all of them
+    connector: aiohttp.TCPConnector = aiohttp.TCPConnector(limit=0, limit_per_host=args.threads * RANGE_PARTS,
+                                                           ttl_dns_cache=600, keepalive_timeout=75,
+                                                           enable_cleanup_closed=True)
+    session: aiohttp.client.ClientSession = aiohttp.ClientSession(connector=connector)
+    queue: asyncio.Queue = asyncio.Queue()
     for entry in entries:
-        path: str = entry[4]
-        if args.skip and os.path.exists(path):
-            continue
-        if args.check and await check_file(path, entry[2].split(':')[1]):
-            continue
-        tasks.append(asyncio.create_task(
-            download_file(path, path, args.retries, args.wait, args.verbose, build_id, args.base, session))
-        )
-    await asyncio.gather(*tasks)
+        queue.put_nowait((entry[4], os.path.join(build_dir, entry[4]), int(entry[1])))
+    # a fixed pool of workers drains the queue, so only --threads downloads are ever in flight
+    await asyncio.gather(*[download_worker(queue, args.retries, args.wait, args.verbose, build_id, args.base, session)
+                           for _ in range(args.threads)])
     await session.close()
 
 
@@ -13,31 +13,47 @@ _ - separator
 """
 
 import asyncio
+import contextlib
+import functools
 import aiohttp
+import aiofiles
 import orjson
 import os
 import zlib
 import time
 
+CHUNK_BASE_URL: str = "https://battlebreakers-productionlive-cdn.s3.amazonaws.com/WorldExplorersLive"
+DOWNLOAD_BLOCK_SIZE: int = 64 * 1024
+MAX_CONCURRENT_DOWNLOADS: int = 32
+WRITE_BLOCK_SIZE: int = 1 << 20
+BLOB_CACHE_SIZE: int = 4096
 
+
+@functools.lru_cache(maxsize=BLOB_CACHE_SIZE)
 def blob2hex(blob: str, reverse: bool = True, returnInt: bool = True) -> int | str:
     """
     Convert a blob to hex
-    :param blob: The blob to convert
+    :param blob: The blob to convert, three decimal digits per byte
     :param reverse: True to reverse the blob
     :param returnInt: True to return an int
     :return: The hex string or int
     """
-    sets: list = [blob[i:i + 3] for i in range(0, len(blob), 3)]
-    if reverse:
-        sets.reverse()
-    out: str = ""
-    for val in sets:
-        out += "{:02X}".format(int(val))
+    buf: bytes = bytes(int(blob[i:i + 3]) for i in range(0, len(blob), 3))
     if returnInt:
-        return int(out, 16)
-    else:
-        return out
+        return int.from_bytes(buf, "little" if reverse else "big")
+    if reverse:
+        buf = buf[::-1]
+    return buf.hex().upper()
+
+
+def payload_offset(header: bytes | bytearray) -> int:
+    """
+    Get where the compressed data starts in a chunk
+    :param header: At least the first 9 bytes of the chunk
+    :return: The offset of the chunk payload
+    """
+    offset: int = header[8]
+    return 8 if offset == 120 else offset
 
 
 async def decompress(data: bytes) -> bytes:
@@ -46,21 +62,66 @@ async def decompress(data: bytes) -> bytes:
     :param data: The raw response chunk data
     :return: The decompressed chunk data
     """
-    offset: int = data[8]
-    data: bytes = data[8:] if offset == 120 else data[offset:]
+    data: bytes = data[payload_offset(data):]
     try:
         return await asyncio.get_event_loop().run_in_executor(None, zlib.decompress, data)
     except zlib.error:
         return data
 
 
+async def read_chunk(response: aiohttp.ClientResponse, path: str | None = None) -> bytearray | None:
+    """
+    Stream a chunk response, decompressing it and writing it to disk as it arrives
+    :param response: The aiohttp response
+    :param path: The path to save the chunk to, or None to not save it
+    :return: The decompressed chunk data, or None if the chunk is corrupt
+    """
+    loop: asyncio.AbstractEventLoop = asyncio.get_running_loop()
+    decompressor = zlib.decompressobj()
+    header: bytearray | None = bytearray()
+    # The raw payload is only kept until it is known to be zlib data, so it can be returned as-is otherwise
+    payload: bytearray | None = bytearray()
+    out: bytearray = bytearray()
+    async with aiofiles.open(path, "wb") if path is not None else contextlib.nullcontext() as file:
+        async for block in response.content.iter_chunked(DOWNLOAD_BLOCK_SIZE):
+            if file is not None:
+                await file.write(block)
+            if header is not None:
+                # Wait for enough of the header to find where the payload starts
+                header += block
+                if len(header) < 9 or len(header) < payload_offset(header):
+                    continue
+                block = bytes(header[payload_offset(header):])
+                header = None
+            if payload is not None:
+                payload += block
+            if decompressor is None:
+                continue
+            try:
+                out += await loop.run_in_executor(None, decompressor.decompress, block)
+            except zlib.error:
+                decompressor = None
+                continue
+            if out:
+                payload = None
+    if header is None and decompressor is not None:
+        out += decompressor.flush()
+        if decompressor.eof:
+            return out
+    if header is None and payload is not None:
+        # Not zlib data, keep the raw payload like decompress() does
+        return payload
+    print(f"Failed to decompress {response.url}")
+    return None
+
+
 async def download_chunk(session: aiohttp.client.ClientSession, url: str, save_chunks: bool = True) -> bytes | None:
     """
     Download a chunk file
     :param session: The aiohttp session
     :param url: The url to download from
     :param save_chunks: True to save the chunks to disk
-    :return: None
+    :return: The decompressed chunk data, or None if the download failed
     """
     # Extract the file name from the URL
     file_name: str = url.split("/")[-1]
@@ -71,147 +132,162 @@ async def download_chunk(session: aiohttp.client.ClientSession, url: str, save_c
         # Create the directory if it doesn't exist
         os.makedirs(f"chunks/{dir_path}", exist_ok=True)
 
-    async with session.get(url) as response:
-        if response.status == 200:
-            if save_chunks:
-                # if the files are identical, skip writing
-                if os.path.exists(f"chunks/{dir_path}/{file_name}"):
-                    if os.path.getsize(f"chunks/{dir_path}/{file_name}") == int(response.headers["Content-Length"]):
-                        return await decompress(await response.read())
-                with open(f"chunks/{dir_path}/{file_name}", "wb") as file:
-                    file.write(await response.read())
-                    file.close()
-            # print(f"Downloaded {file_name}")
-            return await decompress(await response.read())
-        else:
+    save_path: str | None = f"chunks/{dir_path}/{file_name}" if save_chunks else None
+
+    # if we already have an identical copy, read it from disk instead of downloading it again
+    if save_path is not None and os.path.exists(save_path):
+        async with session.head(url) as response:
+            if response.status == 200 and \
+                    os.path.getsize(save_path) == int(response.headers.get("Content-Length", -1)):
+                async with aiofiles.open(save_path, "rb") as file:
+                    return await decompress(await file.read())
+
+    for attempt in range(2):
+        async with session.get(url) as response:
+            if response.status == 200:
+                # print(f"Downloaded {file_name}")
+                return await read_chunk(response, save_path)
             print(f"Failed to download {url} with status code {response.status}")
+        if attempt == 0:
             await asyncio.sleep(1)
-            async with session.get(url) as response:
-                if response.status == 200:
-                    if save_chunks:
-                        # if the files are identical, skip writing
-                        if os.path.exists(f"chunks/{dir_path}/{file_name}"):
-                            if os.path.getsize(f"chunks/{dir_path}/{file_name}") == int(
-                                    response.headers["Content-Length"]):
-                                return await decompress(await response.read())
-                        with open(f"chunks/{dir_path}/{file_name}", "wb") as file:
-                            file.write(await response.read())
-                            file.close()
-                    # print(f"Downloaded {file_name}")
-                    return await decompress(await response.read())
-                else:
-                    print(f"Failed to download {url} with status code {response.status}")
-                    return None
-
-
-async def main(platform: str = "Android_ASTC", build: str = "CL_3302067", save_chunks: bool = True,
-               pakchunk: int = 1) -> None:
+    return None
+
+
+async def download_worker(session: aiohttp.client.ClientSession, queue: asyncio.Queue, results: dict[str, bytes | None],
+                          save_chunks: bool = True) -> None:
     """
-    The main function
+    Download queued chunk urls one at a time until the queue is empty
+    :param session: The aiohttp session
+    :param queue: The queue of chunk urls to download
+    :param results: Where to store each chunk's data, keyed by url
+    :param save_chunks: True to save the chunks to disk
+    :return: None
+    """
+    while not queue.empty():
+        url: str = queue.get_nowait()
+        results[url] = await download_chunk(session, url, save_chunks)
+
+
+async def process_manifest(session: aiohttp.client.ClientSession, platform: str = "Android_ASTC",
+                           build: str = "CL_3302067", save_chunks: bool = True, pakchunk: int = 1) -> None:
+    """
+    Download and assemble the chunks for a single pakchunk manifest
+    :param session: The aiohttp session
     :param platform: The platform to download chunks for
     :param build: The build to download chunks for
     :param save_chunks: True to save the chunks to disk
     :param pakchunk: The pakchunk to download chunks for
     :return: None
     """
+    # loop through each manifest
+    for file in os.listdir(f"manifests/{build}/{platform}"):
+        if file.endswith(f"WorldExplorers_pakchunk{pakchunk}{build}.manifest"):
+            # Read the manifest file
+            # print(f"Reading {file}")
+            with open(f"manifests/{build}/{platform}/{file}", "rb") as file:
+                manifest: dict = orjson.loads(file.read())
+
+            # Decode every chunk part once up front: (guid, offset, size, data group, chunk hash)
+            data_groups: dict = manifest["DataGroupList"]
+            chunk_hashes: dict = manifest["ChunkHashList"]
+            file_parts: list[list[tuple[str, int, int, int, int]]] = [
+                [(part["Guid"], blob2hex(part["Offset"]), blob2hex(part["Size"]), int(data_groups[part["Guid"]]),
+                  blob2hex(chunk_hashes[part["Guid"]])) for part in filemanifest["FileChunkParts"]]
+                for filemanifest in manifest["FileManifestList"]]
+
+            # Queue one download per unique chunk, parts that reuse a chunk share its result
+            queue: asyncio.Queue = asyncio.Queue()
+            chunk_data: dict[str, bytes | None] = {}
+            part_urls: list[list[str]] = []
+            for filemanifest, parts in zip(manifest["FileManifestList"], file_parts):
+                # Everything up to the data group is the same for every chunk in the file
+                url_prefix: str = (f"{CHUNK_BASE_URL}/{manifest['BuildVersionString']}/"
+                                   f"{filemanifest['Filename'].split('-')[1].split('.')[0]}/ChunksV3/")
+                urls: list[str] = []
+                for guid, _, _, data_group, chunk_hash in parts:
+                    url: str = f"{url_prefix}{data_group:02d}/{chunk_hash:016X}_{guid}.chunk"
+                    if url not in chunk_data:
+                        chunk_data[url] = None
+                        queue.put_nowait(url)
+                    urls.append(url)
+                part_urls.append(urls)
+
+            # Wait for a fixed pool of workers to download all the chunks
+            await asyncio.gather(*[download_worker(session, queue, chunk_data, save_chunks)
+                                   for _ in range(MAX_CONCURRENT_DOWNLOADS)])
+
+            # Loop through each chunk and copy it into place in the pak chunk
+            for filemanifest, parts, urls in zip(manifest["FileManifestList"], file_parts, part_urls):
+                # Allocate the whole file once so each chunk is written in place
+                pak_chunk: bytearray = bytearray(sum(part[2] for part in parts))
+                pak_view: memoryview = memoryview(pak_chunk)
+                file_start: int = 0
+                for (_, offset, size, _, _), url in zip(parts, urls):
+                    try:
+                        pak_view[file_start:file_start + size] = chunk_data[url][offset:offset + size]
+                    except:
+                        print(f"Failed to update {filemanifest['Filename']}")
+                    file_start += size
+                pak_view.release()
+                try:
+                    os.makedirs(
+                        f"chunks/{build}/{platform}/Chunks/Installed/base{filemanifest['Filename'].split('pakchunk')[1].split('-')[0]}",
+                        exist_ok=True)
+                    with open(
+                        f"chunks/{build}/{platform}/Chunks/Installed/base{filemanifest['Filename'].split('pakchunk')[1].split('-')[0]}/{filemanifest['Filename']}",
+                        "wb", buffering=0) as file:
+                        # Write straight from the assembled buffer, skipping the extra copy buffered IO makes
+                        with memoryview(pak_chunk) as view:
+                            written: int = 0
+                            while written < len(view):
+                                written += file.write(view[written:written + WRITE_BLOCK_SIZE])
+                        print(f"Writing {filemanifest['Filename']}")
+                        file.close()
+                except:
+                    print(f"Failed to write {filemanifest['Filename']}")
+                    continue
+
+
+async def main(platform: str = "Android_ASTC", builds: list[str] | None = None, save_chunks: bool = True) -> None:
+    """
+    The main function
+    :param platform: The platform to download chunks for
+    :param builds: The builds to download chunks for
+    :param save_chunks: True to save the chunks to disk
+    :return: None
+    """
     # Create the manifests directory if it doesn't exist
     if not os.path.exists("manifests"):
         os.makedirs("manifests")
     if not os.path.exists("chunks"):
         os.makedirs("chunks")
 
-    # Create the aiohttp session
-    async with aiohttp.ClientSession() as session:
-        # loop through each manifest
-        for file in os.listdir(f"manifests/{build}/{platform}"):
-            if file.endswith(f"WorldExplorers_pakchunk{pakchunk}{build}.manifest"):
-                # Read the manifest file
-                # print(f"Reading {file}")
-                with open(f"manifests/{build}/{platform}/{file}", "r", encoding='utf-8') as file:
-                    manifest: dict = orjson.loads(file.read())
-
-                # Create a list of chunk download coroutines
-                download_tasks: list = []
-                for filemanifest in manifest["FileManifestList"]:
-                    for filechunk in filemanifest["FileChunkParts"]:
-                        # Download the chunk
-                        url = ("https://battlebreakers-productionlive-cdn.s3.amazonaws.com/WorldExplorersLive/{}/{"
-                               "}/ChunksV3/{:02d}/{:016X}_{}.chunk").format(
-                            manifest['BuildVersionString'],
-                            filemanifest['Filename'].split('-')[1].split('.')[0],
-                            int(manifest['DataGroupList'][filechunk['Guid']]),
-                            blob2hex(manifest['ChunkHashList'][filechunk['Guid']]),
-                            filechunk['Guid']
-                        )
-                        # if the file already exists, skip downloading
-                        # Extract the directory path from the URL
-                        dir_path = "/".join(url.split("/")[4:-1])
-                        # if os.path.exists(f"chunks/{dir_path}/{url.split('/')[-1]}"):
-                        #     continue
-                        download_tasks.append(download_chunk(session, url, save_chunks))
-
-                # Wait for all the chunks to download
-                chunk_data_list = await asyncio.gather(*download_tasks)
-
-                # Loop through each chunk and update the pak chunk
-                pak_chunk: bytearray = bytearray()
-                for filemanifest in manifest["FileManifestList"]:
-                    for filechunk in filemanifest["FileChunkParts"]:
-                        try:
-                            # Get the chunk data and update the pak chunk
-                            filechunk["Offset"]: int = blob2hex(filechunk["Offset"])
-                            filechunk["Size"]: int = blob2hex(filechunk["Size"])
-                            chunk_data: bytes = chunk_data_list.pop(0)[
-                                                filechunk["Offset"]:filechunk["Offset"] + filechunk["Size"]]
-                            filechunk["FileStart"] = 0
-                            if filechunk != filemanifest["FileChunkParts"][0]:
-                                filechunk["FileStart"] = \
-                                    filemanifest["FileChunkParts"][filemanifest["FileChunkParts"].index(filechunk) - 1][
-                                        "FileStart"] + \
-                                    filemanifest["FileChunkParts"][filemanifest["FileChunkParts"].index(filechunk) - 1][
-                                        "Size"]
-                            pak_chunk: bytes = pak_chunk[:filechunk["FileStart"]] + chunk_data + pak_chunk[
-                                                                                                 filechunk[
-                                                                                                     "FileStart"] +
-                                                                                                 filechunk["Size"]:]
-                        except:
-                            print(f"Failed to update {filemanifest['Filename']}")
-                            continue
-                    try:
-                        os.makedirs(
-                            f"chunks/{build}/{platform}/Chunks/Installed/base{filemanifest['Filename'].split('pakchunk')[1].split('-')[0]}",
-                            exist_ok=True)
-                        with open(
-                            f"chunks/{build}/{platform}/Chunks/Installed/base{filemanifest['Filename'].split('pakchunk')[1].split('-')[0]}/{filemanifest['Filename']}",
-                            "wb") as file:
-                            file.write(pak_chunk)
-                            print(f"Writing {filemanifest['Filename']}")
-                            file.close()
-                    except:
-                        print(f"Failed to write {filemanifest['Filename']}")
-                        continue
+    # Start the timer
+    start_time: float = time.time()
 
-        # Close the aiohttp session
-        await session.close()
+    # Create one aiohttp session for every build, keeping connections to the CDN alive between manifests
+    connector: aiohttp.TCPConnector = aiohttp.TCPConnector(limit=0, limit_per_host=MAX_CONCURRENT_DOWNLOADS,
+                                                           ttl_dns_cache=600, keepalive_timeout=75,
+                                                           enable_cleanup_closed=True)
+    async with aiohttp.ClientSession(connector=connector) as session:
+        for build in builds or ["CL_3302067"]:
+            for file in os.listdir(f"manifests/{build}/{platform}"):
+                if file.endswith(f".manifest"):
+                    await process_manifest(session, platform, build, save_chunks,
+                                           int(file.split("pakchunk")[1].split("CL")[0]))
+                    # Blobs rarely repeat across manifests, so don't carry the cache over
+                    blob2hex.cache_clear()
 
+            # Print the time it took to run
+            print("--- %s seconds ---" % (time.time() - start_time) + ".. for build " + build)
 
-if __name__ == "__main__":
-    # Start the timer
-    start_time: float = time.time()
 
+if __name__ == "__main__":
     # build = "CL_3302067"
     platform: str = "Android_ETC1"
 
     builds: list[str] = ["CL_3719898", "CL_3842684", "CL_3891207"]
     # builds = ["CL_3693860"]
 
-    for build in builds:
-        # Run the main function
-        loop: asyncio.AbstractEventLoop = asyncio.get_event_loop()
-        for file in os.listdir(f"manifests/{build}/{platform}"):
-            if file.endswith(f".manifest"):
-                loop.run_until_complete(main(platform, build, True, int(file.split("pakchunk")[1].split("CL")[0])))
-        # loop.run_until_complete(main())
-
-        # Print the time it took to run
-        print("--- %s seconds ---" % (time.time() - start_time) + ".. for build " + build)
+    # Run the main function
+    asyncio.run(main(platform, builds, True))
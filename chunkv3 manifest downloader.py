@@ -40,7 +40,7 @@ async def main() -> None:
     # Create the aiohttp session
     async with aiohttp.ClientSession() as session:
         # Read the master.manifest file
-        with open("master.manifest", "r", encoding='utf-8') as file:
+        with open("master.manifest", "rb") as file:
             master_manifest: dict = orjson.loads(file.read())
 
         # Loop through each chunk
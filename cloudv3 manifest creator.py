@@ -23,7 +23,7 @@ From a given ChangeList number, this script will try to create a manifest for al
         - "uniqueFilename" : filename,
         - "length" : size in bytes,
         - "URL" : filename,
-        - "hash" : sha1 hash of the file,
+        - "hash" : sha1 hash of the file (only if COMPUTE_LEGACY_SHA1),
         - "hash256" : sha256 hash of the file
     - Save the master manifest file to ./manifests/CL_{ChangeList}/{Platform}.manifest
   - If the folder ./manifests/CL_{ChangeList}/{Platform} is empty:
@@ -35,25 +35,79 @@ import json
 import hashlib
 import asyncio
 import aiohttp
+import aiofiles
+
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
 
 MAX_ERRORS: int = 15
 MAX_ERROR: int = 5
 MAX_RETRIES: int = 2
-CHANGELIST: str = input("Enter the changelist number: ")
+MAX_CONCURRENT_REQUESTS: int = 32
 PLATFORMS: list[str] = ["Android_ASTC", "Android_ATC", "Android_DXT", "Android_ETC1", "Android_ETC2", "Android_PVRTC",
                         "IOS", "WindowsNoEditor"]
 PENDING_CL: list[str] = ["3677158", "4076582"]
+HASH_BLOCK_SIZE: int = 64 * 1024
+PROCESS_HASH_THRESHOLD: int = 1 << 20
+SMALL_HASH_BATCH: int = 64
+# sha1 is only kept for older master manifest readers, turning it off roughly halves the time spent hashing
+COMPUTE_LEGACY_SHA1: bool = True
+
+
+def _dumps(obj: dict) -> bytes:
+    """
+    Serializes an object to compact JSON, using orjson when it's installed
+    :param obj: The object to serialize
+    :return: The UTF-8 encoded JSON
+    """
+    if orjson is not None:
+        return orjson.dumps(obj)
+    return json.dumps(obj, separators=(",", ":")).encode()
+
+
+def _hash_file(path: str) -> tuple[int, str | None, str]:
+    """
+    Hashes a file with sha1 and sha256 in a single pass, feeding both from the same cache-sized block as it's read
+    :param path: The path to the file
+    :return: The length, uppercase sha1 (None if COMPUTE_LEGACY_SHA1 is off) and sha256 hex digests of the file
+    """
+    sha1 = hashlib.sha1() if COMPUTE_LEGACY_SHA1 else None
+    sha256 = hashlib.sha256()
+    # bind the update methods once rather than looking them up for every block
+    updates: list = [sha256.update] if sha1 is None else [sha1.update, sha256.update]
+    buffer: bytearray = bytearray(HASH_BLOCK_SIZE)
+    length: int = 0
+    with memoryview(buffer) as view, open(path, "rb", buffering=0) as file:
+        while size := file.readinto(buffer):
+            length += size
+            for update in updates:
+                update(view[:size])
+    return length, sha1.hexdigest().upper() if sha1 is not None else None, sha256.hexdigest().upper()
+
+
+def _hash_files(paths: list[str]) -> list[tuple[int, str | None, str]]:
+    """
+    Hashes a batch of files in one go, so small files share a single executor job
+    :param paths: The paths to the files
+    :return: The length, sha1 and sha256 of each file
+    """
+    return [_hash_file(path) for path in paths]
 
 
 async def download_manifest(session: aiohttp.client.ClientSession, platform: str, paknumber: int,
-                            changelist: str) -> bytes | None:
+                            changelist: str, path: str) -> tuple[int, str | None, str] | None:
     """
-    Downloads a manifest file
+    Downloads a manifest file, hashing it as it is written to disk
     :param session: The aiohttp session
     :param platform: The platform
     :param paknumber: The paknumber
     :param changelist: The changelist
-    :return: The manifest file
+    :param path: The path to save the manifest file to
+    :return: The length, sha1 and sha256 of the manifest file
     """
     # battlebreakers-productiondev-cdn.s3.amazonaws.com via dfu3c9cojym2w.cloudfront.net WorldExplorersDevLatest
     # battlebreakers-productionlive-cdn.s3.amazonaws.com via d1nwd9qr43mkip.cloudfront.net WorldExplorersLive
@@ -61,25 +115,53 @@ async def download_manifest(session: aiohttp.client.ClientSession, platform: str
             f"https://battlebreakers-productionlive-cdn.s3.amazonaws.com/WorldExplorersLive/CL_{changelist}/{platform}"
             f"/WorldExplorers_pakchunk{paknumber}CL_{changelist}.manifest") as response:
         if response.status == 200:
-            return await response.read()
+            sha1 = hashlib.sha1() if COMPUTE_LEGACY_SHA1 else None
+            sha256 = hashlib.sha256()
+            length: int = 0
+            # Stream into a .part file so a failed download never leaves a truncated manifest under its real name
+            try:
+                async with aiofiles.open(f"{path}.part", "wb") as file:
+                    async for block in response.content.iter_chunked(HASH_BLOCK_SIZE):
+                        length += len(block)
+                        if sha1 is not None:
+                            sha1.update(block)
+                        sha256.update(block)
+                        await file.write(block)
+            except BaseException:
+                if os.path.exists(f"{path}.part"):
+                    os.remove(f"{path}.part")
+                raise
+            os.replace(f"{path}.part", path)
+            return length, sha1.hexdigest().upper() if sha1 is not None else None, sha256.hexdigest().upper()
         return None
 
 
-async def download_manifests(session: aiohttp.client.ClientSession, platform: str, changelist: str) -> None:
+async def download_manifests(session: aiohttp.client.ClientSession, platform: str, changelist: str,
+                             semaphore: asyncio.Semaphore, hash_pool: ThreadPoolExecutor,
+                             process_pool: ProcessPoolExecutor) -> None:
     """
     Downloads all manifest files for a given platform
     :param session: The aiohttp session
     :param platform: The platform
     :param changelist: The changelist
+    :param semaphore: Limits how many manifest requests run at once
+    :param hash_pool: The thread pool that hashes small manifests
+    :param process_pool: The process pool that hashes large manifests
     :return: None
     """
     print(f"Downloading manifests for {platform}")
     if not os.path.exists(f"manifests/CL_{changelist}/{platform}"):
         print(f"Creating folder manifests/CL_{changelist}/{platform}")
         os.makedirs(f"manifests/CL_{changelist}/{platform}")
+    # A hard kill mid download leaves a .part file behind, clear them out so they never end up in the master manifest
+    for filename in os.listdir(f"manifests/CL_{changelist}/{platform}"):
+        if filename.endswith(".part"):
+            os.remove(f"manifests/CL_{changelist}/{platform}/{filename}")
     paknumber: int = 0
     errors: int = 0
     retries: int = 0
+    # length and hashes of the manifests downloaded this run, so they don't need to be read back
+    downloaded: dict[str, tuple[int, str | None, str]] = {}
     while errors < MAX_ERRORS:
         paknumber += 1
         filename: str = f"WorldExplorers_pakchunk{paknumber}CL_{changelist}.manifest"
@@ -90,15 +172,16 @@ async def download_manifests(session: aiohttp.client.ClientSession, platform: st
             continue
         manifest: None = None
         while retries < MAX_RETRIES:
-            manifest: bytes = await download_manifest(session, platform, paknumber, changelist)
+            async with semaphore:
+                manifest: tuple[int, str | None, str] = await download_manifest(
+                    session, platform, paknumber, changelist, f"manifests/CL_{changelist}/{platform}/{filename}")
             if manifest is not None:
                 break
             # print(f"Retrying {filename} ({retries + 1}/{MAX_RETRIES})")
             retries += 1
         if manifest is not None:
-            print(f"Writing {filename}")
-            with open(f"manifests/CL_{changelist}/{platform}/{filename}", "wb") as file:
-                file.write(manifest)
+            print(f"Wrote {filename}")
+            downloaded[filename] = manifest
             errors: int = 0
             retries: int = 0
         else:
@@ -140,25 +223,71 @@ async def download_manifests(session: aiohttp.client.ClientSession, platform: st
         print(f"Didn't download anything for CL_{changelist}/{platform}")
     else:
         print(f"Creating master manifest for {platform}")
-        master_manifest: dict[str, int | str | list[dict[str, str | int]]] = {
+        master_manifest: dict[str, int | str] = {
             "ClientVersion": int(changelist),
-            "BuildUrl": f"CL_{changelist}/{platform}",
-            "files": []
+            "BuildUrl": f"CL_{changelist}/{platform}"
         }
-        for filename in os.listdir(f"manifests/CL_{changelist}/{platform}"):
-            with open(f"manifests/CL_{changelist}/{platform}/{filename}", "rb") as file:
-                data: bytes = file.read()
-            master_manifest["files"].append({
-                "filename": filename,
-                "uniqueFilename": filename,
-                "length": len(data),
-                "URL": filename,
-                "hash": hashlib.sha1(data).hexdigest().upper(),
-                "hash256": hashlib.sha256(data).hexdigest().upper()
-            })
-        with open(f"manifests/CL_{changelist}/{platform}.manifest", "w") as file:
-            json.dump(master_manifest, file, indent=4)
-        print(f"Done creating master manifest for {platform}, found {len(master_manifest['files'])} files")
+        filenames: list[str] = os.listdir(f"manifests/CL_{changelist}/{platform}")
+        existing: list[str] = [filename for filename in filenames if filename not in downloaded]
+        # Hash the manifests from earlier runs all at once, straight from disk: large ones get a process each, small
+        # ones are grouped so thousands of tiny files don't each pay for a trip through the executor
+        loop: asyncio.AbstractEventLoop = asyncio.get_running_loop()
+        large: list[str] = []
+        small: list[str] = []
+        for filename in existing:
+            path: str = f"manifests/CL_{changelist}/{platform}/{filename}"
+            (large if os.path.getsize(path) > PROCESS_HASH_THRESHOLD else small).append(filename)
+        batches: list[list[str]] = [small[i:i + SMALL_HASH_BATCH] for i in range(0, len(small), SMALL_HASH_BATCH)]
+        results: list = await asyncio.gather(
+            *[loop.run_in_executor(process_pool, _hash_file, f"manifests/CL_{changelist}/{platform}/{filename}")
+              for filename in large],
+            *[loop.run_in_executor(hash_pool, _hash_files,
+                                   [f"manifests/CL_{changelist}/{platform}/{filename}" for filename in batch])
+              for batch in batches])
+        downloaded.update(zip(large, results))
+        for batch, batch_hashes in zip(batches, results[len(large):]):
+            downloaded.update(zip(batch, batch_hashes))
+        # Write to a temporary file first so a crash never leaves a half-written master manifest behind
+        path: str = f"manifests/CL_{changelist}/{platform}.manifest"
+        with open(f"{path}.tmp", "wb") as file:
+            # Write each entry as soon as it's built so the entry dicts are never all held at once
+            write = file.write
+            dumps = _dumps
+            write(dumps(master_manifest)[:-1] + b',"files":[\n')
+            for i, filename in enumerate(filenames):
+                length, sha1, sha256 = downloaded.pop(filename)
+                entry: dict[str, str | int] = {
+                    "filename": filename,
+                    "uniqueFilename": filename,
+                    "length": length,
+                    "URL": filename
+                }
+                if COMPUTE_LEGACY_SHA1:
+                    entry["hash"] = sha1
+                entry["hash256"] = sha256
+                write(dumps(entry) if i == 0 else b",\n" + dumps(entry))
+            write(b"\n]}")
+        os.replace(f"{path}.tmp", path)
+        print(f"Done creating master manifest for {platform}, found {len(filenames)} files")
+
+
+async def download_changelist(session: aiohttp.client.ClientSession, changelist: str,
+                              semaphore: asyncio.Semaphore, hash_pool: ThreadPoolExecutor,
+                              process_pool: ProcessPoolExecutor) -> None:
+    """
+    Downloads the manifest files for every platform of a changelist at once
+    :param session: The aiohttp session
+    :param changelist: The changelist
+    :param semaphore: Limits how many manifest requests run at once
+    :param hash_pool: The thread pool that hashes small manifests
+    :param process_pool: The process pool that hashes large manifests
+    :return: None
+    """
+    print(f"Downloading manifests for CL_{changelist}")
+    os.makedirs(f"manifests/CL_{changelist}", exist_ok=True)
+    await asyncio.gather(*[download_manifests(session, platform, changelist, semaphore, hash_pool, process_pool)
+                           for platform in PLATFORMS])
+    print(f"Done downloading manifests for CL_{changelist}")
 
 
 async def main() -> None:
@@ -166,26 +295,33 @@ async def main() -> None:
     The main function
     :return: None
     """
-    if CHANGELIST == "":
+    # Prompt here rather than at import, hash worker processes re-import this module on spawn
+    changelist: str = input("Enter the changelist number: ")
+    if changelist == "":
         print("No changelist provided, exiting")
         return
-    if CHANGELIST == "pending":
-        for changelist in PENDING_CL:
-            print(f"Downloading manifests for CL_{changelist}")
-            if not os.path.exists("manifests"):
-                os.makedirs("manifests")
-            if not os.path.exists(f"manifests/CL_{changelist}"):
-                os.makedirs(f"manifests/CL_{changelist}")
-            async with aiohttp.ClientSession() as session:
-                await asyncio.gather(*[download_manifests(session, platform, changelist) for platform in PLATFORMS])
-            print(f"Done downloading manifests for CL_{changelist}")
-        return
-    if not os.path.exists("manifests"):
-        os.makedirs("manifests")
-    if not os.path.exists(f"manifests/CL_{CHANGELIST}"):
-        os.makedirs(f"manifests/CL_{CHANGELIST}")
-    async with aiohttp.ClientSession() as session:
-        await asyncio.gather(*[download_manifests(session, platform, CHANGELIST) for platform in PLATFORMS])
+    # hashlib's OpenSSL backend already dispatches to SHA-NI on CPUs that have it, the builtin fallback doesn't
+    if not (hashlib.sha1.__name__.startswith("openssl_") and hashlib.sha256.__name__.startswith("openssl_")):
+        print("Warning: hashlib isn't using OpenSSL, hashing will be slower")
+    # One session for the whole run, so warm connections are reused across changelists
+    # Cleaning up closed transports stops half-closed SSL sockets piling up under the changelist x platform fan-out
+    connector: aiohttp.TCPConnector = aiohttp.TCPConnector(limit=128, limit_per_host=MAX_CONCURRENT_REQUESTS,
+                                                           ttl_dns_cache=300, keepalive_timeout=60,
+                                                           force_close=False, enable_cleanup_closed=True)
+    # hashlib releases the GIL on large buffers, so one thread per platform lets every platform hash at once
+    # Big manifests are worth the IPC to hash on another core, small ones stay on the thread pool
+    with ThreadPoolExecutor(max_workers=len(PLATFORMS)) as hash_pool, \
+            ProcessPoolExecutor(max_workers=os.cpu_count()) as process_pool:
+        async with aiohttp.ClientSession(connector=connector,
+                                         timeout=aiohttp.ClientTimeout(total=None, connect=10,
+                                                                       sock_read=60)) as session:
+            semaphore: asyncio.Semaphore = asyncio.Semaphore(MAX_CONCURRENT_REQUESTS)
+            if changelist == "pending":
+                # Every changelist is independent, so download them all at the same time
+                await asyncio.gather(*[download_changelist(session, pending, semaphore, hash_pool, process_pool)
+                                       for pending in PENDING_CL])
+                return
+            await download_changelist(session, changelist, semaphore, hash_pool, process_pool)
 
 
 if __name__ == "__main__":